@@ -1,14 +1,151 @@
 """
 FFmpeg processing utilities
 """
+import csv
 import subprocess
 import os
-import json
+import shutil
+import multiprocessing
 import tempfile
-from typing import List, Dict, Optional
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
+
+import orjson
+
+# NVENC tuning (only used when the h264_nvenc encoder is available)
+NVENC_PRESET = os.environ.get('NVENC_PRESET', 'p4')
+NVENC_CQ = os.environ.get('NVENC_CQ', '23')
+# Consumer GPUs refuse NVENC sessions past a small driver limit (5-8)
+NVENC_MAX_SESSIONS = int(os.environ.get('NVENC_MAX_SESSIONS', '3'))
+
+# Frame rate every clip is normalized to before concatenation
+NORMALIZE_FPS = os.environ.get('NORMALIZE_FPS', '30')
+
+# Tiny synthetic input for the hardware probes below. Listing -encoders or
+# -filters only describes the build; distro ffmpeg reports NVENC and the
+# CUDA filters even when no GPU is attached, so actually run the hardware.
+_PROBE_INPUT = ['-f', 'lavfi', '-i', 'color=s=256x256:d=0.1']
+
+def _probe_succeeds(args: List[str]) -> bool:
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-loglevel', 'error', *args, '-f', 'null', '-'],
+            capture_output=True,
+            timeout=30
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+def _probe_nvenc() -> bool:
+    """Check that h264_nvenc can actually encode on this machine"""
+    return _probe_succeeds(['-init_hw_device', 'cuda', *_PROBE_INPUT, '-c:v', 'h264_nvenc'])
+
+def _probe_hw_scaler() -> Optional[str]:
+    """Return the first CUDA scale filter that runs on this machine, if any"""
+    chains = {
+        'scale_npp': 'scale_npp=format=yuv420p,hwdownload,format=yuv420p',
+        'scale_cuda': 'scale_cuda=w=128:h=128,hwdownload,format=nv12',
+    }
+    for name, chain in chains.items():
+        if _probe_succeeds([
+            '-init_hw_device', 'cuda=gpu', '-filter_hw_device', 'gpu',
+            *_PROBE_INPUT,
+            '-vf', f'format=nv12,hwupload,{chain}'
+        ]):
+            return name
+    return None
+
+# Probed once at import so every request reuses the result
+NVENC_AVAILABLE = _probe_nvenc()
+HW_SCALER = _probe_hw_scaler()
+NVDEC_AVAILABLE = HW_SCALER is not None
+
+# Caps concurrent ffmpeg/ffprobe children across the whole service. A
+# multiprocessing semaphore created at import (gunicorn --preload) is shared
+# by every worker forked from the master, unlike a threading one.
+FFMPEG_MAX_CONCURRENT = int(os.environ.get('FFMPEG_MAX_CONCURRENT', os.cpu_count() or 1))
+_ffmpeg_slots = multiprocessing.BoundedSemaphore(FFMPEG_MAX_CONCURRENT)
+_nvenc_slots = multiprocessing.BoundedSemaphore(NVENC_MAX_SESSIONS)
+
+def _run(cmd: List[str], **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run gated by the service-wide ffmpeg concurrency limit"""
+    with _ffmpeg_slots:
+        return subprocess.run(cmd, **kwargs)
+
+def _hw_download() -> str:
+    """Filter chain that brings full-resolution CUDA frames back as yuv420p
+    
+    Scene scores depend on resolution and pixel layout, so the GPU path hands
+    the select filter the same frames the CPU decoder would.
+    """
+    if HW_SCALER == 'scale_npp':
+        return 'scale_npp=format=yuv420p,hwdownload,format=yuv420p'
+    return 'hwdownload,format=nv12,format=yuv420p'
+
+def _hw_downscale(width: int) -> str:
+    """Filter chain that resizes in VRAM and downloads only the small frame"""
+    if HW_SCALER == 'scale_npp':
+        return f'scale_npp=w={width}:h=-2:format=yuv420p,hwdownload,format=yuv420p'
+    return f'scale_cuda=w={width}:h=-2,hwdownload,format=nv12'
+
+# Results memoized per file identity; a changed mtime or size is a new key
+CACHE_SIZE = 256
+
+class LRUCache:
+    """Small thread-safe LRU cache"""
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+    
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+_info_cache = LRUCache(CACHE_SIZE)
+_scene_cache = LRUCache(CACHE_SIZE)
+
+def file_key(path: str) -> Tuple[str, int, int]:
+    """Cache key that changes whenever the file is rewritten"""
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size)
+
+def _staging_path(output_path: str) -> str:
+    """Fresh file next to output_path, to be os.replace()d over it when done
+    
+    Writing in place would truncate whatever inode output_path currently
+    points at, which may be a hardlinked source clip.
+    """
+    fd, path = tempfile.mkstemp(
+        dir=os.path.dirname(output_path) or '.',
+        prefix='.staging_',
+        suffix=os.path.splitext(output_path)[1]
+    )
+    os.close(fd)
+    return path
 
 def get_video_info(video_path: str) -> Dict:
     """Get video metadata using ffprobe"""
+    key = file_key(video_path)
+    cached = _info_cache.get(key)
+    if cached is not None:
+        return cached
+    
     cmd = [
         'ffprobe',
         '-v', 'quiet',
@@ -17,8 +154,10 @@ def get_video_info(video_path: str) -> Dict:
         '-show_streams',
         video_path
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    return json.loads(result.stdout)
+    result = _run(cmd, capture_output=True)
+    info = orjson.loads(result.stdout)
+    _info_cache.put(key, info)
+    return info
 
 def extract_audio(video_path: str, output_path: str) -> bool:
     """Extract audio from video as WAV"""
@@ -31,11 +170,27 @@ def extract_audio(video_path: str, output_path: str) -> bool:
         output_path,
         '-y'
     ]
-    result = subprocess.run(cmd, capture_output=True)
+    result = _run(cmd, capture_output=True)
     return result.returncode == 0
 
 def generate_thumbnail(video_path: str, output_path: str, time: float = 1.0) -> bool:
     """Generate thumbnail from video"""
+    if NVDEC_AVAILABLE:
+        # Decode and resize on the GPU; only the 320px frame is downloaded
+        cmd = [
+            'ffmpeg', '-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda',
+            '-ss', str(time),
+            '-i', video_path,
+            '-vframes', '1',
+            '-vf', _hw_downscale(320),
+            '-q:v', '3',
+            output_path,
+            '-y'
+        ]
+        result = _run(cmd, capture_output=True)
+        if result.returncode == 0:
+            return True
+    
     cmd = [
         'ffmpeg', '-i', video_path,
         '-ss', str(time),
@@ -44,49 +199,293 @@ def generate_thumbnail(video_path: str, output_path: str, time: float = 1.0) ->
         output_path,
         '-y'
     ]
-    result = subprocess.run(cmd, capture_output=True)
+    result = _run(cmd, capture_output=True)
     return result.returncode == 0
 
+def _stream_scene_times(cmd: List[str]) -> Tuple[int, List[float]]:
+    """Run a showinfo filter graph, reading scene times from stderr as it streams"""
+    scenes = [0.0]  # Always start at 0
+    with _ffmpeg_slots:
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            bufsize=1 << 20
+        )
+        for line in proc.stderr:
+            if b'pts_time:' in line:
+                try:
+                    scenes.append(float(line.split(b'pts_time:')[1].split()[0]))
+                except (IndexError, ValueError):
+                    pass
+        proc.wait()
+    return proc.returncode, scenes
+
 def detect_scenes(video_path: str, threshold: float = 0.3) -> List[float]:
     """Detect scene changes in video"""
+    key = (file_key(video_path), threshold)
+    cached = _scene_cache.get(key)
+    if cached is not None:
+        return list(cached)
+    
+    if NVDEC_AVAILABLE:
+        # Decode on NVDEC at full resolution so scores match the CPU path
+        cmd = [
+            'ffmpeg', '-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda',
+            '-i', video_path,
+            '-vf', f'{_hw_download()},select=\'gt(scene,{threshold})\',showinfo',
+            '-f', 'null', '-'
+        ]
+        returncode, scenes = _stream_scene_times(cmd)
+        if returncode == 0:
+            _scene_cache.put(key, scenes)
+            return list(scenes)
+    
     cmd = [
         'ffmpeg', '-i', video_path,
         '-vf', f'select=\'gt(scene,{threshold})\',showinfo',
         '-f', 'null', '-'
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
     
     # Parse scene timestamps from stderr
-    scenes = [0.0]  # Always start at 0
-    for line in result.stderr.split('\n'):
-        if 'pts_time:' in line:
-            try:
-                pts_time = float(line.split('pts_time:')[1].split()[0])
-                scenes.append(pts_time)
-            except:
-                pass
+    returncode, scenes = _stream_scene_times(cmd)
+    if returncode == 0:
+        _scene_cache.put(key, scenes)
+    return list(scenes)
+
+def process_all(
+    video_path: str,
+    thumb_path: str,
+    audio_path: str,
+    thumb_time: float = 1.0,
+    threshold: float = 0.3
+) -> Dict:
+    """Generate thumbnail, scene list and audio track from a single decode"""
+    info = get_video_info(video_path)
+    has_audio = any(s.get('codec_type') == 'audio' for s in info.get('streams', []))
+    
+    staged_thumb = _staging_path(thumb_path)
+    staged_audio = _staging_path(audio_path)
+    
+    with tempfile.TemporaryDirectory() as work_dir:
+        scenes_file = os.path.join(work_dir, 'scenes.txt')
+        filter_graph = (
+            '[0:v]split=2[t][s];'
+            f'[t]select=\'gte(t,{thumb_time})\',scale=320:-1[thumb];'
+            f'[s]select=\'gt(scene,{threshold})\',metadata=print:file={scenes_file}[scenes]'
+        )
+        cmd = [
+            'ffmpeg', '-i', video_path,
+            '-filter_complex', filter_graph,
+            '-map', '[thumb]', '-frames:v', '1', staged_thumb,
+            '-map', '[scenes]', '-f', 'null', '-'
+        ]
+        if has_audio:
+            cmd += [
+                '-map', '0:a:0',
+                '-acodec', 'pcm_s16le',
+                '-ar', '16000',  # Sample rate for whisper
+                '-ac', '1',  # Mono
+                staged_audio
+            ]
+        cmd.append('-y')
+        result = _run(cmd, capture_output=True)
+        success = result.returncode == 0
+        
+        # Swap outputs in whole so concurrent readers never see partial files
+        written = {}
+        for name, staged, final, expected in (
+            ('thumbnail', staged_thumb, thumb_path, True),
+            ('audio', staged_audio, audio_path, has_audio)
+        ):
+            written[name] = success and expected and os.path.getsize(staged) > 0
+            if written[name]:
+                os.replace(staged, final)
+            else:
+                os.remove(staged)
+        
+        # Parse scene timestamps from the metadata file
+        scenes = [0.0]  # Always start at 0
+        if os.path.exists(scenes_file):
+            with open(scenes_file) as f:
+                for line in f:
+                    if 'pts_time:' in line:
+                        try:
+                            scenes.append(float(line.split('pts_time:')[1].split()[0]))
+                        except (IndexError, ValueError):
+                            pass
     
-    return scenes
+    if success:
+        # Later detect_scenes calls with the same threshold skip the decode
+        _scene_cache.put((file_key(video_path), threshold), list(scenes))
+    return {
+        'success': success,
+        'thumbnail': written['thumbnail'],
+        'audio': written['audio'],
+        'scenes': scenes
+    }
 
 def extract_clip(
     video_path: str,
     output_path: str,
     start_time: float,
-    end_time: float
+    end_time: float,
+    precise: bool = False
 ) -> bool:
-    """Extract a clip from video"""
+    """Extract a clip from video
+    
+    By default -ss is given before -i so ffmpeg seeks in the demuxer instead
+    of decoding up to start_time. With -c copy the cut then lands on the
+    nearest keyframe; pass precise=True to seek after -i instead.
+    """
     duration = end_time - start_time
+    if precise:
+        seek = ['-i', video_path, '-ss', str(start_time)]
+    else:
+        seek = ['-ss', str(start_time), '-i', video_path]
+    # output_path may be hardlinked as a single-clip highlight; swap in a
+    # fresh file rather than truncating that shared inode
+    staged = _staging_path(output_path)
     cmd = [
-        'ffmpeg', '-i', video_path,
-        '-ss', str(start_time),
+        'ffmpeg', *seek,
         '-t', str(duration),
         '-c', 'copy',
+        staged,
+        '-y'
+    ]
+    result = _run(cmd, capture_output=True)
+    if result.returncode != 0:
+        os.remove(staged)
+        return False
+    os.replace(staged, output_path)
+    return True
+
+# How far a segment's actual cut may sit from the requested boundary (s)
+SEGMENT_TOLERANCE = 0.05
+
+def extract_clips_from_scenes(
+    video_path: str,
+    ranges: List[Tuple[float, float]],
+    output_dir: str,
+    prefix: str = 'scene'
+) -> List[Optional[str]]:
+    """Extract several clips with a single stream-copy pass
+    
+    Every range boundary becomes a segment muxer cut point. With -c copy the
+    muxer can only cut on keyframes, so segments are matched to ranges by
+    the start/end times it reports in its CSV segment list rather than by
+    index. Ranges whose boundaries did not land on a cut fall back to
+    extract_clip. Ranges must not overlap. Returns output paths in the
+    order of ranges, with None for any range that could not be extracted.
+    """
+    ordered = sorted((float(start), float(end)) for start, end in ranges)
+    for start, end in ordered:
+        if end <= start:
+            raise ValueError(f'Invalid range: {start}-{end}')
+    for (_, prev_end), (next_start, _) in zip(ordered, ordered[1:]):
+        if next_start < prev_end:
+            raise ValueError('Ranges must not overlap')
+    
+    boundaries = sorted({t for pair in ordered for t in pair if t > 0})
+    
+    # Work inside output_dir so kept segments are renamed, not copied
+    with tempfile.TemporaryDirectory(dir=output_dir) as work_dir:
+        segment_list = os.path.join(work_dir, 'segments.csv')
+        cmd = [
+            'ffmpeg', '-i', video_path,
+            '-f', 'segment',
+            '-segment_times', ','.join(str(t) for t in boundaries),
+            '-segment_list', segment_list,
+            '-segment_list_type', 'csv',
+            '-reset_timestamps', '1',
+            '-c', 'copy',
+            os.path.join(work_dir, 'seg_%05d.mp4'),
+            '-y'
+        ]
+        result = _run(cmd, capture_output=True)
+        
+        # (filename, actual start, actual end) for every segment written
+        segments = []
+        if result.returncode == 0 and os.path.exists(segment_list):
+            with open(segment_list, newline='') as f:
+                for row in csv.reader(f):
+                    try:
+                        segments.append((os.path.basename(row[0]), float(row[1]), float(row[2])))
+                    except (IndexError, ValueError):
+                        pass
+        
+        outputs = []
+        for start, end in ranges:
+            start, end = float(start), float(end)
+            output_path = os.path.join(output_dir, f'{prefix}_{start}_{end}.mp4')
+            match = next((
+                segment for segment in segments
+                if abs(segment[1] - start) <= SEGMENT_TOLERANCE
+                and abs(segment[2] - end) <= SEGMENT_TOLERANCE
+            ), None)
+            if match:
+                # Each segment file can be moved out only once
+                segments.remove(match)
+                os.replace(os.path.join(work_dir, match[0]), output_path)
+                outputs.append(output_path)
+            elif extract_clip(video_path, output_path, start, end):
+                outputs.append(output_path)
+            else:
+                outputs.append(None)
+        return outputs
+
+_NVENC_ARGS = [
+    '-c:v', 'h264_nvenc', '-preset', NVENC_PRESET, '-tune', 'hq',
+    '-rc', 'vbr', '-cq', NVENC_CQ, '-b:v', '0'
+]
+_X264_ARGS = [
+    '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'fastdecode', '-crf', '22',
+    '-threads', '0', '-x264-params', 'sliced-threads=1:threads=0'
+]
+
+def _video_encoder_args() -> List[List[str]]:
+    """Video encoder arguments to try in order, GPU first when available"""
+    if NVENC_AVAILABLE:
+        return [_NVENC_ARGS, _X264_ARGS]
+    return [_X264_ARGS]
+
+def _normalize_clip(
+    clip_path: str,
+    output_path: str,
+    width: int,
+    height: int,
+    video_args: List[str]
+) -> bool:
+    """Re-encode a clip to the shared codec/fps/resolution used for concatenation"""
+    video_filter = (
+        f'scale={width}:{height}:force_original_aspect_ratio=decrease,'
+        f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={NORMALIZE_FPS}'
+    )
+    cmd = [
+        'ffmpeg', '-i', clip_path,
+        '-vf', video_filter,
+        *video_args,
+        '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k', '-ar', '48000', '-ac', '2',
         output_path,
         '-y'
     ]
-    result = subprocess.run(cmd, capture_output=True)
+    # Stay under the driver's NVENC session limit across concurrent requests
+    sessions = _nvenc_slots if video_args is _NVENC_ARGS else nullcontext()
+    with sessions:
+        result = _run(cmd, capture_output=True)
     return result.returncode == 0
 
+def _target_resolution(clip_path: str) -> Tuple[int, int]:
+    """Resolution of the first video stream, rounded down to even dimensions"""
+    try:
+        info = get_video_info(clip_path)
+        stream = next(s for s in info.get('streams', []) if s.get('codec_type') == 'video')
+        width, height = int(stream['width']), int(stream['height'])
+    except Exception:
+        return 1280, 720
+    return width - width % 2, height - height % 2
+
 def concatenate_clips(
     clip_paths: List[str],
     output_path: str,
@@ -94,47 +493,92 @@ def concatenate_clips(
 ) -> bool:
     """Concatenate multiple clips with crossfade transitions"""
     if len(clip_paths) == 1:
-        # Just copy the single clip
-        subprocess.run(['cp', clip_paths[0], output_path])
+        # Hardlink the single clip; fall back to an in-kernel copy across filesystems
+        if os.path.abspath(clip_paths[0]) == os.path.abspath(output_path):
+            return True
+        staged = _staging_path(output_path)
+        os.remove(staged)  # os.link needs a free name
+        try:
+            os.link(clip_paths[0], staged)
+        except OSError:
+            shutil.copyfile(clip_paths[0], staged)
+        os.replace(staged, output_path)
         return True
     
-    # Create concat file
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as f:
-        for clip in clip_paths:
-            f.write(f"file '{clip}'\n")
-        concat_file = f.name
+    # Normalize every clip in parallel so the final join can stream-copy
+    width, height = _target_resolution(clip_paths[0])
+    # Threads suffice: each one just waits on an ffmpeg child, and _run keeps
+    # the total within FFMPEG_MAX_CONCURRENT
+    workers = max(1, min(len(clip_paths), (os.cpu_count() or 2) // 2, FFMPEG_MAX_CONCURRENT))
     
-    try:
-        # Build filter complex for crossfade
-        filter_parts = []
-        n = len(clip_paths)
+    with tempfile.TemporaryDirectory() as work_dir:
+        normalized = [
+            os.path.join(work_dir, f'part_{i:04d}.mp4')
+            for i in range(len(clip_paths))
+        ]
+        # Every part must come from the same encoder: the concat demuxer keeps
+        # the first file's SPS/PPS, so mixed NVENC/libx264 parts decode as
+        # garbage. If any part fails, re-encode them all with the next one.
+        for video_args in _video_encoder_args():
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(
+                    _normalize_clip,
+                    clip_paths,
+                    normalized,
+                    [width] * len(clip_paths),
+                    [height] * len(clip_paths),
+                    [video_args] * len(clip_paths)
+                ))
+            if all(results):
+                break
+        else:
+            return False
+        
+        # Feed the concat list over stdin instead of a temp file. Entries need
+        # an explicit file: protocol, or ffmpeg resolves them against pipe:0
+        concat_list = ''.join(
+            "file 'file:{}'\n".format(clip.replace("'", "'\\''")) for clip in normalized
+        ).encode()
         
-        # Simple concat without transitions for now
+        # Simple concat without transitions for now; write to a fresh file
+        # and swap it in so an existing output inode is never truncated
+        staged = _staging_path(output_path)
         cmd = [
             'ffmpeg', '-f', 'concat', '-safe', '0',
-            '-i', concat_file,
-            '-c:v', 'libx264', '-preset', 'fast', '-crf', '22',
-            '-c:a', 'aac', '-b:a', '128k',
-            output_path,
+            '-protocol_whitelist', 'pipe,file',
+            '-i', 'pipe:0',
+            '-c', 'copy',
+            staged,
             '-y'
         ]
         
-        result = subprocess.run(cmd, capture_output=True)
-        return result.returncode == 0
-    finally:
-        os.remove(concat_file)
+        result = _run(cmd, input=concat_list, capture_output=True)
+        if result.returncode != 0:
+            os.remove(staged)
+            return False
+        os.replace(staged, output_path)
+        return True
 
 def extract_audio_segment(
     video_path: str,
     output_path: str,
     start_time: float,
-    end_time: float
+    end_time: float,
+    precise: bool = False
 ) -> bool:
-    """Extract audio segment from video"""
+    """Extract audio segment from video
+    
+    Seeks before -i like extract_clip; -accurate_seek keeps the cut
+    sample-accurate since the audio is re-encoded anyway. precise=True
+    falls back to seeking after -i.
+    """
     duration = end_time - start_time
+    if precise:
+        seek = ['-i', video_path, '-ss', str(start_time)]
+    else:
+        seek = ['-accurate_seek', '-ss', str(start_time), '-i', video_path]
     cmd = [
-        'ffmpeg', '-i', video_path,
-        '-ss', str(start_time),
+        'ffmpeg', *seek,
         '-t', str(duration),
         '-vn',
         '-acodec', 'pcm_s16le',
@@ -143,5 +587,5 @@ def extract_audio_segment(
         output_path,
         '-y'
     ]
-    result = subprocess.run(cmd, capture_output=True)
+    result = _run(cmd, capture_output=True)
     return result.returncode == 0
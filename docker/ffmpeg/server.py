@@ -4,6 +4,7 @@ Flask server for FFmpeg processing API
 import os
 import json
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify, send_file
 from process import (
     get_video_info,
@@ -12,7 +13,13 @@ from process import (
     detect_scenes,
     extract_clip,
     concatenate_clips,
-    extract_audio_segment
+    extract_audio_segment,
+    process_all,
+    extract_clips_from_scenes,
+    file_key,
+    LRUCache,
+    CACHE_SIZE,
+    FFMPEG_MAX_CONCURRENT
 )
 
 app = Flask(__name__)
@@ -21,6 +28,39 @@ UPLOAD_DIR = '/app/uploads'
 OUTPUT_DIR = '/app/output'
 TEMP_DIR = '/app/temp'
 
+# Ensure directories exist (runs once under gunicorn --preload)
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(TEMP_DIR, exist_ok=True)
+
+DEFAULT_THUMB_TIME = 1.0
+DEFAULT_SCENE_THRESHOLD = 0.3
+
+# Results of process_all, keyed by (path, mtime, size) so edits invalidate them
+_prepared = LRUCache(CACHE_SIZE)
+
+def _thumbnail_path(video_path):
+    return os.path.join(
+        OUTPUT_DIR,
+        os.path.splitext(os.path.basename(video_path))[0] + '_thumb.jpg'
+    )
+
+def _audio_path(video_path):
+    return os.path.join(
+        TEMP_DIR,
+        os.path.splitext(os.path.basename(video_path))[0] + '_audio.wav'
+    )
+
+def _file_response(path, mimetype):
+    """Stream the file itself for ?stream=1, otherwise return its path as JSON
+    
+    send_file serves the body with the kernel's sendfile() via the WSGI file
+    wrapper and honors Range/conditional requests.
+    """
+    if request.args.get('stream') == '1':
+        return send_file(path, mimetype=mimetype, conditional=True)
+    return jsonify({'success': True, 'path': path})
+
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'healthy', 'service': 'ffmpeg'})
@@ -36,6 +76,20 @@ def video_info():
     
     try:
         info = get_video_info(video_path)
+        
+        # Decode once for thumbnail, scenes and audio so later routes hit the cache
+        key = file_key(video_path)
+        if data.get('prepare', True) and _prepared.get(key) is None:
+            result = process_all(
+                video_path,
+                _thumbnail_path(video_path),
+                _audio_path(video_path),
+                DEFAULT_THUMB_TIME,
+                DEFAULT_SCENE_THRESHOLD
+            )
+            if result['success']:
+                _prepared.put(key, result)
+        
         return jsonify({'success': True, 'info': info})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -45,20 +99,24 @@ def thumbnail():
     """Generate video thumbnail"""
     data = request.json
     video_path = data.get('path')
-    time = data.get('time', 1.0)
+    time = data.get('time', DEFAULT_THUMB_TIME)
     
     if not video_path or not os.path.exists(video_path):
         return jsonify({'error': 'Video not found'}), 404
     
     try:
-        output_path = os.path.join(
-            OUTPUT_DIR,
-            os.path.splitext(os.path.basename(video_path))[0] + '_thumb.jpg'
-        )
+        output_path = _thumbnail_path(video_path)
+        prepared = _prepared.get(file_key(video_path))
+        if prepared and prepared['thumbnail'] and time == DEFAULT_THUMB_TIME \
+                and os.path.exists(output_path):
+            return _file_response(output_path, 'image/jpeg')
+        if prepared:
+            prepared['thumbnail'] = False  # About to be overwritten
+        
         success = generate_thumbnail(video_path, output_path, time)
         
         if success:
-            return jsonify({'success': True, 'path': output_path})
+            return _file_response(output_path, 'image/jpeg')
         else:
             return jsonify({'error': 'Thumbnail generation failed'}), 500
     except Exception as e:
@@ -69,7 +127,7 @@ def scenes():
     """Detect scene changes"""
     data = request.json
     video_path = data.get('path')
-    threshold = data.get('threshold', 0.3)
+    threshold = data.get('threshold', DEFAULT_SCENE_THRESHOLD)
     
     if not video_path or not os.path.exists(video_path):
         return jsonify({'error': 'Video not found'}), 404
@@ -92,13 +150,19 @@ def extract_audio_route():
         return jsonify({'error': 'Video not found'}), 404
     
     try:
-        output_path = os.path.join(
-            TEMP_DIR,
-            os.path.splitext(os.path.basename(video_path))[0] + '_audio.wav'
-        )
+        output_path = _audio_path(video_path)
+        prepared = _prepared.get(file_key(video_path))
+        if prepared and prepared['audio'] and not end_time and not start_time \
+                and os.path.exists(output_path):
+            return jsonify({'success': True, 'path': output_path})
+        if prepared:
+            prepared['audio'] = False  # About to be overwritten
         
         if end_time:
-            success = extract_audio_segment(video_path, output_path, start_time, end_time)
+            success = extract_audio_segment(
+                video_path, output_path, start_time, end_time,
+                precise=data.get('precise', False)
+            )
         else:
             success = extract_audio(video_path, output_path)
         
@@ -129,15 +193,99 @@ def extract_clip_route():
             output_name = f'clip_{start_time}_{end_time}.mp4'
         output_path = os.path.join(OUTPUT_DIR, output_name)
         
-        success = extract_clip(video_path, output_path, start_time, end_time)
+        success = extract_clip(
+            video_path, output_path, start_time, end_time,
+            precise=data.get('precise', False)
+        )
         
         if success:
-            return jsonify({'success': True, 'path': output_path})
+            return _file_response(output_path, 'video/mp4')
         else:
             return jsonify({'error': 'Clip extraction failed'}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/extract-clips-batch', methods=['POST'])
+def extract_clips_batch_route():
+    """Extract many clips in parallel"""
+    data = request.json
+    clips = data.get('clips', [])
+    
+    if not clips:
+        return jsonify({'error': 'No clips provided'}), 400
+    
+    for clip in clips:
+        if not all([clip.get('path'), clip.get('start') is not None, clip.get('end')]):
+            return jsonify({'error': 'Missing required parameters'}), 400
+        if not os.path.exists(clip['path']):
+            return jsonify({'error': f"Video not found: {clip['path']}"}), 404
+    
+    try:
+        output_paths = [
+            os.path.join(
+                OUTPUT_DIR,
+                clip.get('output_name') or f"clip_{clip['start']}_{clip['end']}.mp4"
+            )
+            for clip in clips
+        ]
+        
+        # Each thread only waits on an ffmpeg child; size the pool to the
+        # shared ffmpeg limit so extra threads would not just queue
+        with ThreadPoolExecutor(max_workers=min(len(clips), FFMPEG_MAX_CONCURRENT)) as pool:
+            successes = list(pool.map(
+                extract_clip,
+                [clip['path'] for clip in clips],
+                output_paths,
+                [clip['start'] for clip in clips],
+                [clip['end'] for clip in clips],
+                [clip.get('precise', False) for clip in clips]
+            ))
+        
+        results = [
+            {'success': True, 'path': path} if success
+            else {'success': False, 'error': 'Clip extraction failed'}
+            for path, success in zip(output_paths, successes)
+        ]
+        return jsonify({'success': all(successes), 'results': results})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/clips-from-scenes', methods=['POST'])
+def clips_from_scenes_route():
+    """Extract scene clips from one decode-free pass"""
+    data = request.json
+    video_path = data.get('path')
+    ranges = data.get('ranges')
+    threshold = data.get('threshold', DEFAULT_SCENE_THRESHOLD)
+    
+    if not video_path or not os.path.exists(video_path):
+        return jsonify({'error': 'Video not found'}), 404
+    
+    try:
+        if not ranges:
+            # Default to one clip per detected scene
+            scene_times = detect_scenes(video_path, threshold)
+            duration = float(get_video_info(video_path).get('format', {}).get('duration', 0))
+            ranges = [
+                [start, end]
+                for start, end in zip(scene_times, scene_times[1:] + [duration])
+                if end > start
+            ]
+        
+        prefix = os.path.splitext(os.path.basename(video_path))[0]
+        paths = extract_clips_from_scenes(video_path, ranges, OUTPUT_DIR, prefix)
+        
+        results = [
+            {'success': True, 'start': start, 'end': end, 'path': path} if path
+            else {'success': False, 'start': start, 'end': end, 'error': 'Clip extraction failed'}
+            for (start, end), path in zip(ranges, paths)
+        ]
+        return jsonify({'success': all(paths), 'results': results})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/concatenate', methods=['POST'])
 def concatenate_route():
     """Concatenate multiple clips"""
@@ -164,11 +312,3 @@ def concatenate_route():
             return jsonify({'error': 'Concatenation failed'}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-
-if __name__ == '__main__':
-    # Ensure directories exist
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    os.makedirs(TEMP_DIR, exist_ok=True)
-    
-    app.run(host='0.0.0.0', port=8081)
@@ -0,0 +1,117 @@
+"""
+Tests for FFmpeg processing utilities (need ffmpeg on PATH)
+"""
+import shutil
+import subprocess
+
+import pytest
+
+pytest.importorskip('orjson')
+if shutil.which('ffmpeg') is None:
+    pytest.skip('ffmpeg not available', allow_module_level=True)
+
+import process
+
+FPS = 25
+
+@pytest.fixture(scope='module')
+def gop_video(tmp_path_factory):
+    """10s test pattern with a keyframe exactly every second and no B-frames"""
+    path = str(tmp_path_factory.mktemp('fixture') / 'gop25.mp4')
+    subprocess.run([
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc=s=160x120:r={FPS}:d=10',
+        '-c:v', 'libx264', '-bf', '0', '-pix_fmt', 'yuv420p',
+        '-x264-params', f'keyint={FPS}:min-keyint={FPS}:scenecut=0',
+        path, '-y'
+    ], check=True)
+    return path
+
+def frame_hashes(path):
+    """Per-frame MD5s of the decoded video stream"""
+    result = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-i', path, '-map', '0:v', '-f', 'framemd5', '-'],
+        capture_output=True, text=True, check=True
+    )
+    return [
+        line.rsplit(',', 1)[1].strip()
+        for line in result.stdout.splitlines()
+        if line and not line.startswith('#')
+    ]
+
+def test_keyframe_aligned_ranges_come_from_one_segment_pass(gop_video, tmp_path, monkeypatch):
+    def no_fallback(*args, **kwargs):
+        raise AssertionError('aligned ranges should not need extract_clip')
+    monkeypatch.setattr(process, 'extract_clip', no_fallback)
+
+    source = frame_hashes(gop_video)
+    paths = process.extract_clips_from_scenes(gop_video, [(5, 7), (1, 3)], str(tmp_path))
+
+    assert frame_hashes(paths[0]) == source[5 * FPS:7 * FPS]
+    assert frame_hashes(paths[1]) == source[1 * FPS:3 * FPS]
+
+def test_boundaries_inside_one_gop_do_not_shift_later_ranges(gop_video, tmp_path):
+    # 1.2 and 1.6 both fall inside the GOP starting at 1s, so the muxer's
+    # cuts drift from segment_times for everything after them
+    source = frame_hashes(gop_video)
+    paths = process.extract_clips_from_scenes(
+        gop_video, [(1.2, 1.6), (2, 4), (6, 8)], str(tmp_path)
+    )
+
+    assert all(paths)
+    assert frame_hashes(paths[1]) == source[2 * FPS:4 * FPS]
+    assert frame_hashes(paths[2]) == source[6 * FPS:8 * FPS]
+
+def test_overlapping_ranges_are_rejected(gop_video, tmp_path):
+    with pytest.raises(ValueError):
+        process.extract_clips_from_scenes(gop_video, [(1, 3), (2, 4)], str(tmp_path))
+
+def test_concatenation_reencodes_every_part_when_one_gpu_encode_fails(gop_video, tmp_path, monkeypatch):
+    clips = process.extract_clips_from_scenes(gop_video, [(1, 2), (3, 4), (5, 6)], str(tmp_path))
+
+    # Stand in a CPU encode for NVENC and fail it for the middle clip only
+    fake_nvenc = ['-c:v', 'libx264', '-preset', 'ultrafast']
+    monkeypatch.setattr(process, 'NVENC_AVAILABLE', True)
+    monkeypatch.setattr(process, '_NVENC_ARGS', fake_nvenc)
+    real_normalize = process._normalize_clip
+    encoded = {}
+    def flaky_normalize(clip_path, output_path, width, height, video_args):
+        if video_args is fake_nvenc and clip_path == clips[1]:
+            return False
+        encoded[output_path] = video_args
+        return real_normalize(clip_path, output_path, width, height, video_args)
+    monkeypatch.setattr(process, '_normalize_clip', flaky_normalize)
+    monkeypatch.setattr(process, '_target_resolution', lambda path: (160, 120))
+
+    output = str(tmp_path / 'highlight.mp4')
+    assert process.concatenate_clips(clips, output)
+    assert all(args is process._X264_ARGS for args in encoded.values())
+    assert len(frame_hashes(output)) == 3 * int(process.NORMALIZE_FPS)
+
+def test_reextracting_a_clip_leaves_a_single_clip_highlight_intact(gop_video, tmp_path):
+    clip = str(tmp_path / 'clip.mp4')
+    highlight = str(tmp_path / 'highlight.mp4')
+    assert process.extract_clip(gop_video, clip, 1, 3)
+    assert process.concatenate_clips([clip], highlight)
+    before = frame_hashes(highlight)
+
+    assert process.extract_clip(gop_video, clip, 6, 7)
+    assert frame_hashes(highlight) == before
+    assert frame_hashes(clip) != before
+
+def test_ranges_sharing_one_segment_fall_back_instead_of_failing(tmp_path):
+    # With every frame a keyframe, segments are one 0.04s frame long, so
+    # both ranges sit within SEGMENT_TOLERANCE of the 1.00-1.04 segment
+    intra = str(tmp_path / 'intra.mp4')
+    subprocess.run([
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc=s=160x120:r={FPS}:d=2',
+        '-c:v', 'libx264', '-g', '1', '-pix_fmt', 'yuv420p',
+        intra, '-y'
+    ], check=True)
+    paths = process.extract_clips_from_scenes(
+        intra, [(1.0, 1.02), (1.02, 1.04)], str(tmp_path)
+    )
+
+    assert all(paths)
+    assert len(set(paths)) == 2
@@ -0,0 +1,20 @@
+"""
+Gunicorn hooks for the whisper API
+"""
+import itertools
+import os
+
+def pre_fork(server, worker):
+    """Give each worker the lowest index no live worker holds, reusing it on respawn"""
+    taken = {getattr(w, 'index', None) for w in server.WORKERS.values()}
+    worker.index = next(i for i in itertools.count() if i not in taken)
+
+def post_fork(server, worker):
+    # server.py derives its whisper-server port and GPU from this
+    os.environ['WHISPER_WORKER_INDEX'] = str(worker.index)
+
+def worker_exit(server, worker):
+    # Free the port for the replacement worker instead of leaving an orphan
+    # server it could never restart
+    from server import stop_whisper_server
+    stop_whisper_server()
@@ -1,11 +1,17 @@
 """
 Simple Flask server for whisper.cpp transcription API
 """
+import io
 import os
+import re
 import subprocess
 import tempfile
-import json
-from flask import Flask, request, jsonify
+import threading
+import time
+import wave
+import orjson
+import requests
+from flask import Flask, Response, request, jsonify
 
 app = Flask(__name__)
 
@@ -17,31 +23,240 @@ WHISPER_BIN = os.environ.get('WHISPER_BIN', WHISPER_CLI_PATH if os.path.exists(W
 WHISPER_MODEL = os.environ.get('WHISPER_MODEL', 'base.en')
 MODEL_PATH = f'/app/models/ggml-{WHISPER_MODEL}.bin'
 
+# whisper.cpp saturates the CPU/GPU on its own, so cap concurrent runs per worker
+WHISPER_MAX_CONCURRENT = int(os.environ.get('WHISPER_MAX_CONCURRENT', '1'))
+# gunicorn runs one worker per GPU; worker N uses GPU N % GPU_COUNT
+GPU_COUNT = max(1, int(os.environ.get('GPU_COUNT', '1')))
+_whisper_slots = threading.BoundedSemaphore(WHISPER_MAX_CONCURRENT)
+
+# Persistent whisper-server keeps the model loaded between requests.
+# Set WHISPER_SERVER_DISABLED=1 to fork whisper-cli per request instead.
+WHISPER_SERVER_BIN = os.environ.get('WHISPER_SERVER_BIN', '/app/whisper.cpp/build/bin/whisper-server')
+# Base port; each gunicorn worker runs its own server on base + worker index
+WHISPER_SERVER_PORT = int(os.environ.get('WHISPER_SERVER_PORT', '9000'))
+WHISPER_SERVER_STARTUP_TIMEOUT = float(os.environ.get('WHISPER_SERVER_STARTUP_TIMEOUT', '120'))
+WHISPER_SERVER_DISABLED = os.environ.get('WHISPER_SERVER_DISABLED') == '1'
+# /inference timeout: a fixed allowance plus this many seconds per second of audio
+WHISPER_SERVER_TIMEOUT = float(os.environ.get('WHISPER_SERVER_TIMEOUT', '60'))
+WHISPER_SERVER_TIMEOUT_PER_SECOND = float(os.environ.get('WHISPER_SERVER_TIMEOUT_PER_SECOND', '2'))
+_server_proc = None
+_server_lock = threading.Lock()
+
+# Keep uploads and whisper-cli output on tmpfs so they never touch the disk
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Deprecation warnings and common noise in whisper output
+_SKIP_RE = re.compile(r'WARNING:|deprecated|whisper-cli|deprecation-warning|Please use|See https://')
+
 def filter_warnings(text):
     """Remove deprecation and warning messages from whisper output"""
     if not text:
         return text
-    lines = text.split('\n')
-    filtered_lines = []
-    for line in lines:
-        # Skip deprecation warnings and common noise
-        if any(skip in line for skip in [
-            'WARNING:', 'deprecated', 'whisper-cli', 
-            'deprecation-warning', 'Please use', 'See https://'
-        ]):
-            continue
-        filtered_lines.append(line)
-    return '\n'.join(filtered_lines).strip()
+    return '\n'.join(
+        line for line in text.split('\n') if not _SKIP_RE.search(line)
+    ).strip()
 
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'healthy', 'model': WHISPER_MODEL})
 
+def _worker_index():
+    """This worker's slot, set by gunicorn.conf.py after fork (0 outside gunicorn)"""
+    return int(os.environ.get('WHISPER_WORKER_INDEX', '0'))
+
+def _server_url():
+    return f'http://127.0.0.1:{WHISPER_SERVER_PORT + _worker_index()}'
+
+def _whisper_env():
+    """Environment pinning whisper.cpp to this worker's GPU"""
+    return {**os.environ, 'CUDA_VISIBLE_DEVICES': str(_worker_index() % GPU_COUNT)}
+
+def _server_healthy():
+    try:
+        return requests.get(f'{_server_url()}/health', timeout=1).status_code == 200
+    except requests.RequestException:
+        return False
+
+def ensure_whisper_server():
+    """Start the persistent whisper-server on first use and wait until it is ready"""
+    global _server_proc
+    with _server_lock:
+        if _server_healthy():
+            return
+        if _server_proc is None or _server_proc.poll() is not None:
+            _server_proc = subprocess.Popen([
+                WHISPER_SERVER_BIN,
+                '-m', MODEL_PATH,
+                '-t', str(os.cpu_count() or 1),
+                '--host', '127.0.0.1',
+                '--port', str(WHISPER_SERVER_PORT + _worker_index())
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=_whisper_env())
+        deadline = time.monotonic() + WHISPER_SERVER_STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if _server_healthy():
+                return
+            time.sleep(0.25)
+        raise RuntimeError('whisper-server did not become ready')
+
+def stop_whisper_server():
+    """Kill the whisper-server this worker started, e.g. after it wedged"""
+    global _server_proc
+    with _server_lock:
+        if _server_proc is not None and _server_proc.poll() is None:
+            _server_proc.kill()
+            _server_proc.wait()
+        _server_proc = None
+
+def _wav_seconds(audio_bytes):
+    """Approximate duration of WAV bytes (header sizes may be unset when piped)"""
+    try:
+        with wave.open(io.BytesIO(audio_bytes)) as wav:
+            frame_size = wav.getnchannels() * wav.getsampwidth()
+            rate = wav.getframerate()
+    except (wave.Error, EOFError):
+        frame_size, rate = 2, 16000
+    return len(audio_bytes) / (frame_size * rate)
+
+def transcribe_with_server(audio_path, convert, with_segments=True):
+    """Transcribe through the persistent whisper-server; returns segments"""
+    if convert:
+        # Convert to 16 kHz mono WAV in memory
+        result = subprocess.run([
+            'ffmpeg', '-loglevel', 'error', '-i', audio_path,
+            '-ar', '16000', '-ac', '1', '-c:a', 'pcm_s16le',
+            '-f', 'wav', 'pipe:1'
+        ], capture_output=True)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(
+                result.returncode, 'ffmpeg',
+                stderr=result.stderr.decode(errors='replace')
+            )
+        audio_bytes = result.stdout
+    else:
+        with open(audio_path, 'rb') as f:
+            audio_bytes = f.read()
+    
+    timeout = WHISPER_SERVER_TIMEOUT + _wav_seconds(audio_bytes) * WHISPER_SERVER_TIMEOUT_PER_SECOND
+    try:
+        ensure_whisper_server()
+        response = requests.post(
+            f'{_server_url()}/inference',
+            files={'file': ('audio.wav', audio_bytes, 'audio/wav')},
+            data={'response_format': 'verbose_json' if with_segments else 'json'},
+            timeout=timeout
+        )
+    except (OSError, RuntimeError, requests.ConnectionError, requests.Timeout):
+        # Server is down or wedged: restart it next time, use the CLI now
+        stop_whisper_server()
+        return transcribe_with_cli(audio_path, convert, with_segments)
+    response.raise_for_status()
+    
+    if not with_segments:
+        return _single_segment(orjson.loads(response.content).get('text', ''))
+    
+    return [
+        {
+            'start': float(item.get('start', 0.0)),
+            'end': float(item.get('end', 0.0)),
+            'text': segment_text
+        }
+        for item in orjson.loads(response.content).get('segments', [])
+        for segment_text in (filter_warnings(item.get('text', '').strip()),)
+        if segment_text
+    ]
+
+def _single_segment(text):
+    """Wrap untimed transcript text as one segment, or none if it is empty"""
+    clean_text = filter_warnings(text.strip())
+    if not clean_text:
+        return []
+    return [{'start': 0.0, 'end': 0.0, 'text': clean_text}]
+
+def transcribe_with_cli(audio_path, convert, with_segments=True):
+    """Transcribe by running whisper-cli for this request; returns segments"""
+    # Convert to WAV if needed (whisper.cpp requires WAV). The converted
+    # audio is streamed over a pipe into whisper-cli instead of hitting disk.
+    ffmpeg_proc = None
+    whisper_input = audio_path
+    if convert:
+        # ffmpeg stderr goes to a file: a pipe nobody reads until whisper
+        # exits would fill up on a noisy decode and deadlock both processes
+        ffmpeg_errors = tempfile.TemporaryFile(dir=SHM_DIR)
+        ffmpeg_proc = subprocess.Popen([
+            'ffmpeg', '-loglevel', 'error', '-i', audio_path,
+            '-ar', '16000', '-ac', '1', '-c:a', 'pcm_s16le',
+            '-f', 'wav', 'pipe:1'
+        ], stdout=subprocess.PIPE, stderr=ffmpeg_errors, bufsize=1 << 20)
+        whisper_input = '-'
+    
+    # Run whisper.cpp; without segments, read plain text from stdout instead
+    # of round-tripping through a JSON file
+    if with_segments:
+        output_args = [
+            '-oj',  # Output JSON
+            '-of', audio_path  # Output file prefix (on /dev/shm with the upload)
+        ]
+    else:
+        output_args = ['-nt']  # No timestamps
+    whisper_proc = subprocess.Popen([
+        WHISPER_BIN,
+        '-m', MODEL_PATH,
+        '-f', whisper_input,
+        *output_args
+    ], stdin=ffmpeg_proc.stdout if ffmpeg_proc else None,
+       stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=_whisper_env())
+    if ffmpeg_proc:
+        # Drop our copy so ffmpeg gets SIGPIPE if whisper exits early
+        ffmpeg_proc.stdout.close()
+    stdout, _ = whisper_proc.communicate()
+    
+    if ffmpeg_proc:
+        with ffmpeg_errors:
+            if ffmpeg_proc.wait() != 0:
+                ffmpeg_errors.seek(0)
+                raise subprocess.CalledProcessError(
+                    ffmpeg_proc.returncode, 'ffmpeg',
+                    stderr=ffmpeg_errors.read().decode(errors='replace')
+                )
+    
+    if not with_segments:
+        return _single_segment(stdout)
+    
+    # Read JSON output
+    json_output_path = f'{audio_path}.json'
+    if os.path.exists(json_output_path):
+        with open(json_output_path, 'rb') as f:
+            transcript_data = orjson.loads(f.read())
+        os.remove(json_output_path)
+    else:
+        # Parse text output if JSON not available
+        # Filter out deprecation warnings from stdout
+        clean_text = filter_warnings(stdout.strip())
+        transcript_data = {
+            'transcription': [{
+                'timestamps': {'from': '00:00:00', 'to': '00:00:00'},
+                'text': clean_text
+            }]
+        }
+    
+    # Format segments, filtering warnings from segment text and dropping empty ones
+    return [
+        {
+            'start': parse_timestamp(item.get('timestamps', {}).get('from', '00:00:00')),
+            'end': parse_timestamp(item.get('timestamps', {}).get('to', '00:00:00')),
+            'text': segment_text
+        }
+        for item in transcript_data.get('transcription', [])
+        for segment_text in (filter_warnings(item.get('text', '').strip()),)
+        if segment_text
+    ]
+
 @app.route('/transcribe', methods=['POST'])
 def transcribe():
     """
     Transcribe audio file
     Expects: multipart/form-data with 'audio' file
+    Query: segments=0 returns the text as a single untimed segment
     Returns: JSON with transcription segments
     """
     if 'audio' not in request.files:
@@ -50,69 +265,24 @@ def transcribe():
     audio_file = request.files['audio']
     
     # Save to temp file
-    with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp:
+    with tempfile.NamedTemporaryFile(suffix='.wav', dir=SHM_DIR, delete=False) as tmp:
         tmp_path = tmp.name
         audio_file.save(tmp_path)
     
     try:
-        # Convert to WAV if needed (whisper.cpp requires WAV)
-        wav_path = tmp_path
-        if not audio_file.filename.endswith('.wav'):
-            wav_path = tmp_path + '.wav'
-            subprocess.run([
-                'ffmpeg', '-i', tmp_path, '-ar', '16000', '-ac', '1',
-                '-c:a', 'pcm_s16le', wav_path, '-y'
-            ], check=True, capture_output=True)
+        convert = not audio_file.filename.endswith('.wav')
+        with_segments = request.args.get('segments', '1') != '0'
+        with _whisper_slots:
+            if WHISPER_SERVER_DISABLED:
+                segments = transcribe_with_cli(tmp_path, convert, with_segments)
+            else:
+                segments = transcribe_with_server(tmp_path, convert, with_segments)
         
-        # Run whisper.cpp
-        result = subprocess.run([
-            WHISPER_BIN,
-            '-m', MODEL_PATH,
-            '-f', wav_path,
-            '-oj',  # Output JSON
-            '-of', tmp_path  # Output file prefix
-        ], capture_output=True, text=True)
-        
-        # Read JSON output
-        json_output_path = f'{tmp_path}.json'
-        if os.path.exists(json_output_path):
-            with open(json_output_path, 'r') as f:
-                transcript_data = json.load(f)
-            os.remove(json_output_path)
-        else:
-            # Parse text output if JSON not available
-            # Filter out deprecation warnings from stdout
-            clean_text = filter_warnings(result.stdout.strip())
-            transcript_data = {
-                'transcription': [{
-                    'timestamps': {'from': '00:00:00', 'to': '00:00:00'},
-                    'text': clean_text
-                }]
-            }
-        
-        # Clean up
-        os.remove(tmp_path)
-        if wav_path != tmp_path and os.path.exists(wav_path):
-            os.remove(wav_path)
-        
-        # Format response
-        segments = []
-        for item in transcript_data.get('transcription', []):
-            timestamps = item.get('timestamps', {})
-            # Filter warnings from segment text as well
-            segment_text = filter_warnings(item.get('text', '').strip())
-            if segment_text:  # Only add non-empty segments
-                segments.append({
-                    'start': parse_timestamp(timestamps.get('from', '00:00:00')),
-                    'end': parse_timestamp(timestamps.get('to', '00:00:00')),
-                    'text': segment_text
-                })
-        
-        return jsonify({
+        return Response(orjson.dumps({
             'success': True,
             'segments': segments,
             'language': 'en'
-        })
+        }), mimetype='application/json')
         
     except subprocess.CalledProcessError as e:
         return jsonify({
@@ -123,21 +293,19 @@ def transcribe():
         return jsonify({
             'error': str(e)
         }), 500
+    finally:
+        # Clean up
+        os.remove(tmp_path)
+
+# [[HH:]MM:]SS[.,mmm]; hours only when minutes are present
+_TS_RE = re.compile(r'^(?:(?:(\d+):)?(\d+):)?(\d+(?:[.,]\d+)?)$')
 
 def parse_timestamp(ts):
     """Convert timestamp string to seconds"""
-    try:
-        parts = ts.replace(',', '.').split(':')
-        if len(parts) == 3:
-            h, m, s = parts
-            return int(h) * 3600 + int(m) * 60 + float(s)
-        elif len(parts) == 2:
-            m, s = parts
-            return int(m) * 60 + float(s)
-        else:
-            return float(parts[0])
-    except:
+    if not isinstance(ts, str):
         return 0.0
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+    match = _TS_RE.match(ts.strip())
+    if not match:
+        return 0.0
+    h, m, s = match.groups()
+    return int(h or 0) * 3600 + int(m or 0) * 60 + float(s.replace(',', '.'))
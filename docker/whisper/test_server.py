@@ -0,0 +1,39 @@
+"""
+Tests for whisper API helpers
+"""
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('orjson')
+pytest.importorskip('requests')
+
+from server import parse_timestamp
+
+@pytest.mark.parametrize('ts, seconds', [
+    # HH:MM:SS with whisper.cpp's comma or a dot before the milliseconds
+    ('00:00:00,000', 0.0),
+    ('01:02:03,500', 3723.5),
+    ('01:02:03.250', 3723.25),
+    # MM:SS and bare seconds
+    ('02:30', 150.0),
+    ('02:30,5', 150.5),
+    ('42', 42.0),
+    ('7.25', 7.25),
+    (' 00:00:05,000 ', 5.0),
+])
+def test_parse_timestamp(ts, seconds):
+    assert parse_timestamp(ts) == seconds
+
+@pytest.mark.parametrize('ts', [
+    '',
+    'abc',
+    '1:xx',
+    '1.5:30',
+    # The old split-based parser returned the first field (1.0) here; more
+    # than three fields is malformed like any other bad input now
+    '1:2:3:4',
+    None,
+    12,
+])
+def test_parse_timestamp_malformed_is_zero(ts):
+    assert parse_timestamp(ts) == 0.0